@@ -0,0 +1,44 @@
+# This is the numba kernel used by dh_debias_pleiades_gui to compute the North-South bias of a dh map.
+# It lives in its own module so that the GUI does not import numba at startup,
+# and it is compiled with cache=True so that only the very first run pays the compilation.
+# Author: Enrico Mattea.
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def ns_bias_by_row(dh_arr, invalid_arr, inlier_arr, bins_n):
+    """Compute the North-South bias of each row of a dh map.
+
+    The rows are grouped into bins_n bins, the median of the valid stable-terrain pixels of each bin is
+    the bias at the bin center, and the bias of each row is linearly interpolated between the bin centers.
+    The bins are processed in parallel.
+    This is close to, but not the same as, xdem's DirectionalBias(angle=90) binning: the bins span all rows
+    instead of the range covered by the stable terrain, and empty bins are interpolated instead of filled by nearest neighbour."""
+    rows_n, cols_n = dh_arr.shape
+    bin_edges = np.linspace(0, rows_n, bins_n + 1).astype(np.int64)
+    bin_centers = np.empty(bins_n)
+    bin_medians = np.full(bins_n, np.nan)
+
+    for bin_id in prange(bins_n):
+        row_start = bin_edges[bin_id]
+        row_end = bin_edges[bin_id + 1]
+        bin_centers[bin_id] = 0.5 * (row_start + row_end - 1)
+
+        # Gather the valid stable-terrain values of the bin.
+        values = np.empty((row_end - row_start) * cols_n, dtype = dh_arr.dtype)
+        values_n = 0
+        for row_id in range(row_start, row_end):
+            for col_id in range(cols_n):
+                value = dh_arr[row_id, col_id]
+                if inlier_arr[row_id, col_id] and not invalid_arr[row_id, col_id] and np.isfinite(value):
+                    values[values_n] = value
+                    values_n += 1
+        if values_n > 0:
+            bin_medians[bin_id] = np.median(values[:values_n])
+
+    valid_bins = ~np.isnan(bin_medians)
+    if not np.any(valid_bins):
+        raise ValueError("no valid stable-terrain cells in the dh map")
+    return np.interp(np.arange(rows_n).astype(np.float64), bin_centers[valid_bins], bin_medians[valid_bins])
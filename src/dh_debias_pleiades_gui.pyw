@@ -1,6 +1,9 @@
-# This is a small GUI interface to call xdem debiasing of a Pléiades DEM difference, with unstable terrain.
+# This is a small GUI interface to debias a Pléiades DEM difference, with unstable terrain.
 # It is cross-platform and handles exceptions nicely (error textboxes).
-# It only supports North-South undulations, which are corrected with linear interpolation within 1000 bins.
+# It only supports North-South undulations, which are corrected with linear interpolation within 100 to 1000 bins (one bin per 50 rows).
+# This approximates xdem's DirectionalBias(angle=90, fit_or_bin="bin", bin_apply_method="linear") with a parallel numba kernel:
+# unlike xdem, the bins span all rows (not only the range of the stable terrain) and empty bins are filled by linear interpolation
+# (not nearest neighbour), so results differ where the stable terrain does not cover the full height of the grid.
 # Author: Enrico Mattea.
 # Last change: 2025/02/17.
 
@@ -11,6 +14,21 @@ from tkinter import filedialog, messagebox, ttk
 import threading
 
 
+# Set once the heavy modules have been imported by the background preloader.
+modules_preloaded = threading.Event()
+
+
+def preload_modules():
+    """Import the heavy processing modules in the background, while the user selects the input files"""
+    try:
+        import numpy
+        import xdem
+        import geoutils
+        import dh_debias_kernel # Imports numba, the kernel itself is compiled at its first call (or loaded from the numba cache).
+    finally:
+        modules_preloaded.set() # Also on failure, so that the processing thread does not wait forever.
+
+
 def handle_error(exception_message, progress_bar_window, root):
     """Handles exceptions by showing the error message and quitting the program."""
     progress_bar_window.destroy()
@@ -18,103 +36,182 @@ def handle_error(exception_message, progress_bar_window, root):
     root.quit()
 
 
-def update_progress_bar(progress_bar, step):
-    current_value = progress_bar["value"]
-    new_value = min(current_value + step, 100)
-    progress_bar["value"] = new_value
-    return new_value
-
-
-def update_progress_label(progress_label, text):
-    """Update the progress text in the progress window"""
+def update_progress(progress_var, progress_label, value, text):
+    """Update the progress bar and the progress text in the progress window, in a single Tk callback"""
+    progress_var.set(min(value, 100))
     progress_label.config(text=text)
 
 
-def run_debiasing(file_paths, progress_bar_window, progress_bar, progress_bar_label, root):
+def run_debiasing(file_paths, progress_bar_window, progress_var, progress_bar_label, root):
 
     # Hide main window during processing, to avoid potential mess.
     root.withdraw()
 
-    # Begin with some progress! We update the progress bar on the main thread.
-    progress_bar.after(0, update_progress_bar, progress_bar, 10)
 
 
 
+    # Begin with some progress! Each phase updates the progress bar and text once, on the main thread (Tk redraws when idle).
+    root.after_idle(update_progress, progress_var, progress_bar_label, 10, "Loading modules...")
 
     # Import all needed modules. We do it only here so that the GUI loads faster.
-    progress_bar.after(0, update_progress_label, progress_bar_label, "Loading modules...")
+    # They are normally already loaded by the background preloader, then the imports below are instantaneous.
+    modules_preloaded.wait()
     import numpy as np
     import xdem
     from geoutils import Vector
+    import rasterio as rio
+    from rasterio.features import geometry_mask
+
+    # Module to keep memory usage low with large grids.
+    from tempfile import TemporaryFile
 
     # Modules to define output file path.
-    from os.path import abspath as path_abspath, basename as path_basename, dirname as path_dirname, join as path_join
-    from re import sub
+    from os.path import abspath as path_abspath, basename as path_basename, dirname as path_dirname, join as path_join, splitext as path_splitext
 
-    # Module for error handling.
-    from traceback import format_exc
+    # Modules to cache the stable-terrain mask.
+    from os import getpid, remove as file_remove, replace as file_replace
+    from os.path import exists as path_exists, getmtime as path_getmtime
+    from hashlib import md5
+    from glob import escape as glob_escape, glob
 
-    progress_bar.after(0, update_progress_bar, progress_bar, 10)
+    # GDAL configuration for reading the input grid and rasterizing the outlines, scoped with rio.Env.
+    # A block cache larger than the stable-terrain mask keeps rasterization linear in the raster size.
+    # We do not disable the listing of sibling files: the input grid may need them (.hdr, world file, .aux.xml, .msk).
+    gdal_read_config = {"GDAL_CACHEMAX": 2048 * 1024 * 1024} # rio.Env takes an integer cache size in bytes (2 GB).
 
 
 
 
-    progress_bar.after(0, update_progress_label, progress_bar_label, "Loading input data...")
+
+    root.after_idle(update_progress, progress_var, progress_bar_label, 20, "Loading input data...")
     try:
         # Load the dh map to be debiased.
-        dh_r = xdem.DEM(file_paths[0])
+        # We read it block by block into a disk-backed, C-contiguous array (deleted automatically on exit),
+        # so that grids close to the RAM size are served from the file cache instead of swapping.
+        # Always float32: medians and linear interpolation are fine with it, and every pass over the grid moves half the bytes of float64.
+        # The invalid cells come from the GDAL mask band (nodata, but also internal or .msk masks and alpha), as in xdem.DEM(path).
+        with rio.Env(**gdal_read_config), rio.open(file_paths[0], sharing = False) as src:
+            dh_arr = np.memmap(TemporaryFile(), dtype = np.float32, mode = "w+", shape = (src.height, src.width))
+            invalid_arr = np.memmap(TemporaryFile(), dtype = bool, mode = "w+", shape = (src.height, src.width))
+            for _, window in src.block_windows(1):
+                dh_arr[window.toslices()] = src.read(1, window = window, out_dtype = np.float32)
+                invalid_arr[window.toslices()] = src.read_masks(1, window = window) == 0
+            dh_r = xdem.DEM.from_array(np.ma.masked_array(dh_arr, mask = invalid_arr, copy = False), transform = src.transform, crs = src.crs, nodata = src.nodata)
 
         # Load outlines of unstable terrain.
         unstable_v = Vector(file_paths[1])
-        progress_bar.after(0, update_progress_bar, progress_bar, 20)
 
     except Exception as error:
+        from traceback import format_exc # Imported only when needed, to keep the happy path light.
         exceptionlast = format_exc().splitlines()[-1]
         handle_error(f"There was an error loading the input data:\n\n{exceptionlast}\n\nNo output was generated, please correct the error and run the program again.\n\nClick OK to exit.", progress_bar_window, root)
 
 
 
 
-    progress_bar.after(0, update_progress_label, progress_bar_label, "Preparing data...")
+    root.after_idle(update_progress, progress_var, progress_bar_label, 40, "Preparing data...")
     try:
-        inlier_mask = ~unstable_v.create_mask(dh_r) # This is a boolean numpy 2D array. Note the bitwise not (~) symbol
-        dh_zero_r = dh_r.copy()
-        dh_zero_r[inlier_mask] = 0 # We use a zero raster as "reference" against which to debias the dh map.
-        progress_bar.after(0, update_progress_bar, progress_bar, 10)
+        # Stable-terrain mask: boolean numpy 2D array, True outside of the unstable outlines.
+        # It is cached next to the shapefile, keyed on the shapefile modification time and on the grid,
+        # so that a rerun on the same inputs just maps the cached file instead of rasterizing again.
+        mask_key = md5((str(path_getmtime(file_paths[1])) + repr(dh_r.transform) + str(dh_r.crs) + str(dh_r.shape)).encode()).hexdigest()
+        mask_cache_path = f"{file_paths[1]}.{mask_key}.mask.npy"
+        inlier_mask = None
+        if path_exists(mask_cache_path):
+            try:
+                inlier_mask = np.load(mask_cache_path, mmap_mode = "c") # Copy-on-write: the cache file is never modified.
+                if inlier_mask.shape != dh_r.shape or inlier_mask.dtype != bool:
+                    inlier_mask = None
+            except (OSError, ValueError):
+                inlier_mask = None # Unreadable cache (e.g. truncated file): rasterize again, the cache is overwritten below.
+        if inlier_mask is None:
+            with rio.Env(**gdal_read_config):
+                if unstable_v.crs == dh_r.crs and len(unstable_v.ds) > 0:
+                    # Same CRS (the usual case): rasterize the outlines directly, without reprojection checks.
+                    # With invert=False the mask is already True outside of the outlines, no need to invert it.
+                    inlier_mask = geometry_mask(unstable_v.ds.geometry, out_shape = dh_r.shape, transform = dh_r.transform, invert = False)
+                else:
+                    # We invert the rasterized outlines in place, to avoid allocating a second full-size mask.
+                    inlier_mask = unstable_v.create_mask(dh_r, as_array = True)
+                    if not inlier_mask.flags.writeable:
+                        inlier_mask = np.array(inlier_mask, copy = True)
+                    np.logical_not(inlier_mask, out = inlier_mask)
+            # Only the latest cache is kept per shapefile: remove the ones left by older outlines or other grids.
+            for old_mask_cache_path in glob(glob_escape(file_paths[1]) + ".*.mask.npy"):
+                if old_mask_cache_path != mask_cache_path:
+                    try:
+                        file_remove(old_mask_cache_path)
+                    except OSError:
+                        pass
+            # Write to a temporary file in the same folder and move it into place only once complete,
+            # so that a failed write (e.g. disk full) never leaves a truncated cache behind.
+            mask_cache_tmp_path = f"{mask_cache_path}.{getpid()}.tmp"
+            try:
+                with open(mask_cache_tmp_path, "wb") as mask_cache_file:
+                    np.save(mask_cache_file, inlier_mask)
+                file_replace(mask_cache_tmp_path, mask_cache_path)
+            except OSError: # The cache is optional (e.g. read-only shapefile folder).
+                try:
+                    file_remove(mask_cache_tmp_path)
+                except OSError:
+                    pass
+        # Make sure that the mask is C-contiguous for the row scans of the debiasing kernel (no copy if it already is).
+        inlier_mask = np.ascontiguousarray(inlier_mask)
     except Exception as error:
+        from traceback import format_exc
         exceptionlast = format_exc().splitlines()[-1]
         handle_error(f"There was an error creating the stable-terrain mask:\n\n{exceptionlast}\n\nNo output was generated, please correct the error and run the program again.\n\nClick OK to exit.", progress_bar_window, root)
 
 
 
 
-    # Always horizontal bias and 1000 bins,
-    # Pléiades DEMs should always have at least 1000 rows.
-    dirbias = xdem.coreg.DirectionalBias(angle=90, fit_or_bin="bin", bin_sizes=1000, bin_apply_method = "linear")
+    # Always horizontal bias. One bin every 50 rows, between 100 and 1000 bins:
+    # the correction saturates well before 1000 bins, and fewer bins make the binning cheaper.
+    bins_n = max(100, min(1000, dh_r.shape[0] // 50))
 
 
 
 
-    progress_bar.after(0, update_progress_label, progress_bar_label, "Debiasing...")
+    root.after_idle(update_progress, progress_var, progress_bar_label, 50, "Debiasing...")
     try:
-        debiased_r = dirbias.fit_and_apply(dh_zero_r, dh_r, inlier_mask = inlier_mask)
-        progress_bar.after(0, update_progress_bar, progress_bar, 45)
+        # Kernel module (imports numba): inside the try, so that a broken numba/llvmlite install shows an error box.
+        from dh_debias_kernel import ns_bias_by_row
+
+        # Bias of each row, estimated on the valid stable terrain. We pass the plain arrays underlying the masked dh map.
+        dh_arr = np.asarray(np.ma.getdata(dh_r.data))
+        row_bias = ns_bias_by_row(dh_arr, np.ma.getmaskarray(dh_r.data), inlier_mask, bins_n)
+        # Subtract the bias in place: dh_r becomes the debiased map, no second full-size grid is allocated.
+        # Masked cells are modified too, but they stay masked and are written as nodata.
+        np.subtract(dh_arr, row_bias[:, None], out = dh_arr)
     except Exception as error:
+        from traceback import format_exc
         exceptionlast = format_exc().splitlines()[-1]
         handle_error(f"There was an error binning and applying the debiasing:\n\n{exceptionlast}\n\nNo output was generated, please correct the error and run the program again.\n\nClick OK to exit.", progress_bar_window, root)
 
 
 
 
-    progress_bar.after(0, update_progress_label, progress_bar_label, "Writing output...")
+    root.after_idle(update_progress, progress_var, progress_bar_label, 95, "Writing output...")
     out_dirpath=path_dirname(file_paths[0])
-    out_fn=sub("(\.[\w]{1,})$", r"_debias\1", path_basename(file_paths[0])) # Add _debias just before the file extension.
+    out_base, out_ext = path_splitext(path_basename(file_paths[0]))
+    out_fn=f"{out_base}_debias{out_ext}" # Add _debias just before the file extension.
     out_path=path_join(path_abspath(out_dirpath), out_fn)
 
     try:
-        debiased_r.save(out_path)
-        progress_bar.after(0, update_progress_bar, progress_bar, 5)
+        # Tiled and compressed GeoTIFF: smaller file and faster block reads downstream.
+        # Floating-point predictor (3) since the dh map is a float grid.
+        # We write tile by tile with a small GDAL block cache (64 MB), so that written tiles are flushed to disk
+        # as the cache fills up, and the writer memory stays bounded by the cache instead of growing with the grid.
+        out_nodata = dh_r.nodata if dh_r.nodata is not None else -9999
+        out_profile = {"driver": "GTiff", "height": dh_r.height, "width": dh_r.width, "count": 1,
+                       "dtype": dh_r.data.dtype, "crs": dh_r.crs, "transform": dh_r.transform, "nodata": out_nodata,
+                       "compress": "deflate", "tiled": True, "blockxsize": 256, "blockysize": 256, "predictor": 3,
+                       "BIGTIFF": "IF_SAFER", "NUM_THREADS": "ALL_CPUS"}
+        with rio.Env(GDAL_CACHEMAX = 64 * 1024 * 1024), rio.open(out_path, "w", **out_profile) as dst: # Cache size in bytes.
+            for _, window in dst.block_windows(1):
+                dst.write(np.ma.filled(dh_r.data[window.toslices()], out_nodata), 1, window = window)
     except Exception as error:
+        from traceback import format_exc
         exceptionlast = format_exc().splitlines()[-1]
         handle_error(f"There was an error saving the debiased output:\n\n{exceptionlast}\n\nThe output could be missing or wrong, please correct the error and run the program again.\n\nClick OK to exit.", progress_bar_window, root)
 
@@ -127,13 +224,13 @@ def run_debiasing(file_paths, progress_bar_window, progress_bar, progress_bar_la
 
 
 
-def start_process(file_paths, progress_bar_window, progress_bar, progress_bar_label, root):
+def start_process(file_paths, progress_bar_window, progress_var, progress_bar_label, root):
     """Start the long-running function in a separate thread"""
     progress_bar_window.deiconify()  # Show the progress window
     progress_bar_window.attributes("-topmost", 1) # Bring the progress window to top
 
     # Run the long-running function in a separate thread to keep UI responsive
-    threading.Thread(target=run_debiasing, args=(file_paths, progress_bar_window, progress_bar, progress_bar_label, root), daemon=True).start()
+    threading.Thread(target=run_debiasing, args=(file_paths, progress_bar_window, progress_var, progress_bar_label, root), daemon=True).start()
 
 
 def file_selector(entry, file_paths, button, idx):
@@ -200,7 +297,7 @@ def create_main_window():
 
     # Button to trigger the process
     process_button = tk.Button(root, text="Start debiasing", state=tk.DISABLED,
-                                command=lambda: start_process(file_paths, progress_bar_window, progress_bar, progress_bar_label, root))
+                                command=lambda: start_process(file_paths, progress_bar_window, progress_var, progress_bar_label, root))
     process_button.grid(row=4, column=0, columnspan=3, pady=10)
 
     # Progress dialog window (hidden initially)
@@ -211,9 +308,13 @@ def create_main_window():
     progress_bar_label = tk.Label(progress_bar_window, text="Processing...")
     progress_bar_label.pack(pady=10)
 
-    progress_bar = ttk.Progressbar(progress_bar_window, orient="horizontal", length=300, mode="determinate")
+    progress_var = tk.IntVar(value=0)
+    progress_bar = ttk.Progressbar(progress_bar_window, orient="horizontal", length=300, mode="determinate", variable=progress_var, maximum=100)
     progress_bar.pack(pady=20)
 
+    # Load the heavy modules in the background, so that processing starts right away.
+    threading.Thread(target=preload_modules, daemon=True).start()
+
     # Start the Tkinter main loop
     root.mainloop()
 